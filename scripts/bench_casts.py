@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# This source file is part of the EdgeDB open source project.
+#
+# Copyright 2024-present MagicStack Inc. and the EdgeDB authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""Measure the throughput of the ext::postgis output casts and functions.
+
+Every cast case encodes the same generated geometries on a dev instance
+and reports the rows per second and the size of the result, e.g.::
+
+    python scripts/bench_casts.py -I <instance> --rows 100000
+
+The ``json`` cast is compared with ``asjson()`` in every encoding. The
+``json_encoding`` setting is changed for the current database while the
+benchmark runs and reset afterwards.
+
+Boxes are compared by casting them into ``bytes`` either directly or
+through ``geometry``, which produces the EWKB they are sent as otherwise.
+
+The function cases aggregate their results on the server, so they report
+the rows per second and the cost per row of the functions alone. Calls of
+functions that are wrapped into SQL because of their int4 or float4
+parameters are compared with direct calls over ``--scan-rows`` points.
+Deduplicating that many points with ``distinct`` is measured as well.
+Hot scalar functions such as ``x``, ``y``, ``area`` and ``distance`` are
+measured over ``--rows`` points, as are point-in-country joins with and
+without the countries split up by ``subdivide``.
+"""
+
+
+from __future__ import annotations
+
+import time
+import typing
+
+import click
+import edgedb
+
+
+GEOMETRIES = '''
+    for n in range_unpack(range(0, <int64>$rows)) union (
+        ext::postgis::buffer(
+            ext::postgis::makepoint(<float64>n / 997, <float64>(n % 997)),
+            0.5,
+        )
+    )
+'''
+
+JSON_ENCODINGS = ['wkt', 'ewkt', 'hexewkb', 'geojson']
+
+BOX_QUERIES = {
+    'box2d ewkb': '<bytes><ext::postgis::geometry><ext::postgis::box2d>',
+    'box2d bytes': '<bytes><ext::postgis::box2d>',
+    'box3d ewkb': '<bytes><ext::postgis::geometry><ext::postgis::box3d>',
+    'box3d bytes': '<bytes><ext::postgis::box3d>',
+}
+
+# makepoint() calls st_makepoint directly. point() is wrapped into SQL for
+# all overloads because its srid one needs the int4 adapter.
+ADAPTER_QUERIES = {
+    'makepoint direct':
+        'ext::postgis::x(ext::postgis::makepoint(<float64>n, <float64>n))',
+    'point wrapped':
+        'ext::postgis::x(ext::postgis::point(<float64>n, <float64>n))',
+    'point adapted':
+        'ext::postgis::x(ext::postgis::point(<float64>n, <float64>n, 4326))',
+}
+
+# Geometries with only a thousand distinct values, to be deduplicated.
+DUPLICATES = '''
+    for n in range_unpack(range(0, <int64>$rows)) union (
+        ext::postgis::makepoint(<float64>(n % 1000), 0)
+    )
+'''
+
+# The EWKB of the same geometries is deduplicated as bytes for comparison.
+DEDUP_QUERIES = {
+    'distinct geometry': f'count(distinct ({DUPLICATES}))',
+    'distinct ewkb': f'count(distinct <bytes>({DUPLICATES}))',
+}
+
+# Points spread over ten round "countries" with a thousand vertices each,
+# which are joined either as a whole or subdivided into small pieces whose
+# bounding boxes reject most points without a point-in-polygon test.
+COUNTRY_JOIN = '''
+    with
+        countries := (
+            for n in range_unpack(range(0, 10)) union (
+                ext::postgis::buffer(
+                    ext::postgis::makepoint(<float64>n * 10, 0), 4.5, 256)
+            )
+        ),
+        points := (
+            for n in range_unpack(range(0, <int64>$rows)) union (
+                ext::postgis::makepoint(
+                    <float64>(n % 1000) / 10 - 5,
+                    <float64>((n // 1000) % 100) / 10 - 5,
+                )
+            )
+        ),
+    select count(
+        for c in {polygons} union (
+            select points filter ext::postgis::intersects(c, points)
+        )
+    )
+'''
+
+JOIN_QUERIES = {
+    'join countries': COUNTRY_JOIN.format(polygons='countries'),
+    'join subdivided': COUNTRY_JOIN.format(
+        polygons='ext::postgis::subdivide(countries, 64)'),
+}
+
+# Hot scalar functions whose float8 results need no return cast. The
+# baseline only scans the numbers. The point p and the polygon g are built
+# from them, so area and distance also include the cost of buffer().
+ACCESSOR_QUERIES = {
+    'baseline': '<float64>n',
+    'x': 'ext::postgis::x(p)',
+    'y': 'ext::postgis::y(p)',
+    'area': 'ext::postgis::area(g)',
+    'distance': 'ext::postgis::distance(p, g)',
+}
+
+
+def time_query(
+    client: edgedb.Client,
+    query: str,
+    *,
+    rows: int,
+    repeat: int,
+) -> tuple[float, list[typing.Any]]:
+    times = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        res = client.query(query, rows=rows)
+        times.append(time.perf_counter() - start)
+
+    # The first run only warms up the caches.
+    return min(times[1:]), res
+
+
+def run_case(
+    client: edgedb.Client,
+    query: str,
+    **kwargs: typing.Any,
+) -> tuple[float, int]:
+    elapsed, res = time_query(client, query, **kwargs)
+    return elapsed, sum(len(val) for val in res)
+
+
+def report(name: str, rows: int, elapsed: float, size: int) -> None:
+    print(
+        f'{name:<20} {rows / elapsed:>12.0f} rows/s '
+        f'{size / rows:>10.1f} bytes/row'
+    )
+
+
+def report_cost(name: str, rows: int, elapsed: float) -> None:
+    print(
+        f'{name:<20} {rows / elapsed:>12.0f} rows/s '
+        f'{elapsed / rows * 1e9:>10.1f} ns/row'
+    )
+
+
+def bench_json(client: edgedb.Client, **kwargs: typing.Any) -> None:
+    # The cast always produces WKT, asjson() follows the setting.
+    elapsed, size = run_case(
+        client, f'select <json>({GEOMETRIES})', **kwargs)
+    report('json cast', kwargs['rows'], elapsed, size)
+
+    query = f'select ext::postgis::asjson({GEOMETRIES})'
+    try:
+        for encoding in JSON_ENCODINGS:
+            client.execute(
+                f'''
+                configure current database
+                set ext::postgis::Config::json_encoding := '{encoding}';
+                '''
+            )
+            elapsed, size = run_case(client, query, **kwargs)
+            report(f'json {encoding}', kwargs['rows'], elapsed, size)
+    finally:
+        client.execute(
+            '''
+            configure current database
+            reset ext::postgis::Config::json_encoding;
+            '''
+        )
+
+
+def bench_boxes(client: edgedb.Client, **kwargs: typing.Any) -> None:
+    for name, cast in BOX_QUERIES.items():
+        query = f'select {cast}({GEOMETRIES})'
+        elapsed, size = run_case(client, query, **kwargs)
+        report(name, kwargs['rows'], elapsed, size)
+
+
+def bench_functions(
+    client: edgedb.Client,
+    queries: dict[str, str],
+    **kwargs: typing.Any,
+) -> None:
+    for name, expr in queries.items():
+        query = f'''
+            select sum(
+                for n in range_unpack(range(0, <int64>$rows)) union (
+                    with
+                        p := ext::postgis::makepoint(
+                            <float64>n / 997, <float64>(n % 997)),
+                        g := ext::postgis::buffer(p, 0.5),
+                    select {expr}
+                )
+            )
+        '''
+        elapsed, _ = time_query(client, query, **kwargs)
+        report_cost(name, kwargs['rows'], elapsed)
+
+
+def bench_adapters(client: edgedb.Client, **kwargs: typing.Any) -> None:
+    bench_functions(client, ADAPTER_QUERIES, **kwargs)
+
+
+def bench_accessors(client: edgedb.Client, **kwargs: typing.Any) -> None:
+    bench_functions(client, ACCESSOR_QUERIES, **kwargs)
+
+
+def bench_dedup(client: edgedb.Client, **kwargs: typing.Any) -> None:
+    for name, expr in DEDUP_QUERIES.items():
+        elapsed, _ = time_query(client, f'select {expr}', **kwargs)
+        report_cost(name, kwargs['rows'], elapsed)
+
+
+def bench_joins(client: edgedb.Client, **kwargs: typing.Any) -> None:
+    for name, query in JOIN_QUERIES.items():
+        elapsed, _ = time_query(client, query, **kwargs)
+        report_cost(name, kwargs['rows'], elapsed)
+
+
+@click.command('bench-casts')
+@click.option('--dsn', help='DSN of the database to query.')
+@click.option('-I', '--instance', help='Name of the instance to query.')
+@click.option('--rows', type=int, default=100000, show_default=True,
+              help='Number of geometries encoded by each case.')
+@click.option('--scan-rows', type=int, default=1000000, show_default=True,
+              help='Number of rows scanned by the function cases.')
+@click.option('--repeat', type=click.IntRange(min=1), default=5,
+              show_default=True,
+              help='Number of timed runs of each case.')
+def bench_casts(*, dsn, instance, rows, scan_rows, repeat):
+    """Measure the throughput of the ext::postgis output casts and functions.
+    """
+    client = edgedb.create_client(dsn or instance)
+    try:
+        bench_json(client, rows=rows, repeat=repeat)
+        bench_boxes(client, rows=rows, repeat=repeat)
+        bench_accessors(client, rows=rows, repeat=repeat)
+        bench_joins(client, rows=rows, repeat=repeat)
+        bench_adapters(client, rows=scan_rows, repeat=repeat)
+        bench_dedup(client, rows=scan_rows, repeat=repeat)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    bench_casts()
@@ -22,20 +22,34 @@ from __future__ import annotations
 
 import click
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import gc
+import hashlib
 import json
 import os
 import pathlib
+import pickle
 import re
+import resource
 import sys
+import time
+import tomllib
+import typing
 import xml.etree.ElementTree as ET
 import textwrap
 
 from edb.tools.edb import edbcommands
+from edb.pgsql.parser import parser as pgparser
 from edb.pgsql.parser.parser import pg_parse
 from edb.edgeql import ast as qlast
 from edb.edgeql import qltypes
 from edb.edgeql import codegen as qlcodegen
+from edb.edgeql import parser as qlparser
 from edb.common import assert_data_shape
+from edb.common.ast import base as astbase
 
 from postgis_doc import DESC_REWRITES, FUNC_CATEGORIES
 
@@ -45,6 +59,37 @@ EQLINDENT = '.. eql:function:: '
 SIGINDENT = ' ' * len(EQLINDENT)
 INDENT = '    '
 MAXLENGTH = 79
+# Bump this whenever the shape of the cached parse results changes.
+PARSE_CACHE_VERSION = 1
+# Cross-check the comment index against the slow parameter tree comparison.
+DEBUG_COMMENTS = False
+# Per-phase (name, wall time, peak RSS, object count) records, or None if
+# profiling is disabled.
+PROFILE = None
+# Postgres types that map exactly onto the corresponding EdgeDB types.
+EXACT_TYPES = {
+    'geometry', 'geography', 'box2d', 'box3d', 'text', 'float8', 'int8',
+    'int2', 'bool', 'bytea',
+}
+# Postgres types that are exposed as a different EdgeDB type, mapped onto the
+# type that operator calls resolve to when given the EdgeDB type instead.
+CALL_TYPES = {
+    'box2df': 'geometry',
+}
+# Composite row types returned by PostGIS functions, mapped onto the SQL
+# select list that turns the row into the corresponding EdgeDB tuple.
+COMPOSITE_TYPES = {
+    'geometry_dump': 'path::int8[], geom',
+    # The columns are given by the OUT parameters.
+    'record': None,
+}
+# Parameter modes of the columns of the returned record.
+OUT_PARAM_MODES = {'FUNC_PARAM_OUT', 'FUNC_PARAM_TABLE'}
+# Postgres types of the values that EdgeDB widens.
+WIDENED_TYPES = {
+    'int4': 'int8',
+    'float4': 'float8',
+}
 # These functions return NULL (empty set) on some inputs
 OPT_RETURN_FUNC = {
     'linefromtext',
@@ -78,6 +123,39 @@ def die(msg):
     sys.exit(1)
 
 
+@contextlib.contextmanager
+def profile_phase(name):
+    '''Record the wall time, peak RSS and object count of a generator phase.
+    '''
+
+    if PROFILE is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            # ru_maxrss is in KiB everywhere except macOS
+            maxrss *= 1024
+        PROFILE.append((name, wall, maxrss, len(gc.get_objects())))
+
+
+def print_profile(file=None):
+    print(
+        f'{"phase":<28} {"wall, s":>9} {"peak RSS, MiB":>14} {"objects":>10}',
+        file=file,
+    )
+    for name, wall, maxrss, objects in PROFILE:
+        print(
+            f'{name:<28} {wall:>9.3f} {maxrss / 2**20:>14.1f} {objects:>10}',
+            file=file,
+        )
+
+
 def record_broken(*args):
     '''Record functions or operators that are broken by this conversion.
 
@@ -210,6 +288,32 @@ def sql_to_eqltype(ret):
                     ),
                 )
                 break
+            case 'geometry_dump':
+                atype = qlast.TypeName(
+                    maintype=qlast.ObjectRef(name='tuple'),
+                    subtypes=[
+                        qlast.TypeName(
+                            name='path',
+                            maintype=qlast.ObjectRef(name='array'),
+                            subtypes=[
+                                qlast.TypeName(
+                                    maintype=qlast.ObjectRef(
+                                        name='int64',
+                                        module='std',
+                                    ),
+                                ),
+                            ],
+                        ),
+                        qlast.TypeName(
+                            name='geom',
+                            maintype=qlast.ObjectRef(
+                                name='geometry',
+                                module='ext::postgis',
+                            ),
+                        ),
+                    ],
+                )
+                break
             case _:
                 raise Exception(
                     f'unknown type: {name!s}')
@@ -225,6 +329,18 @@ def sql_to_eqltype(ret):
     return atype, pgtype
 
 
+def needs_return_cast(ret):
+    # The function results only need to be cast if the postgres type doesn't
+    # map exactly onto the EdgeDB type (e.g. int4 is exposed as int64).
+    # Composite types are already converted by the function body.
+    for nameobj in ret['names']:
+        name = nameobj['String']['sval']
+        if name != 'pg_catalog':
+            return name not in EXACT_TYPES and name not in COMPOSITE_TYPES
+
+    return True
+
+
 def get_expr(param):
     if param is None:
         return None
@@ -299,11 +415,81 @@ def get_params(params, is_strict):
     return res, callsig, needs_adapter
 
 
+def get_in_params(func):
+    return [
+        p for p in func.get('parameters', [])
+        if p['FunctionParameter'].get('mode') not in OUT_PARAM_MODES
+    ]
+
+
+def get_out_params(func):
+    return [
+        p for p in func.get('parameters', [])
+        if p['FunctionParameter'].get('mode') in OUT_PARAM_MODES
+    ]
+
+
+def get_record_type(func):
+    # Records returned by functions with OUT parameters are mapped onto named
+    # tuples, along with the select list that produces them.
+    subtypes = []
+    cols = []
+    for p in get_out_params(func):
+        fp = p['FunctionParameter']
+        atype, _ = sql_to_eqltype(fp['argType'])
+        atype.name = fp['name']
+        subtypes.append(atype)
+
+        col = f'"{fp["name"]}"'
+        if needs_return_cast(fp['argType']):
+            pgtype = fp['argType']['names'][-1]['String']['sval']
+            if (widened := WIDENED_TYPES.get(pgtype)) is None:
+                # The function gets recorded as broken, but it is easy to
+                # miss that it is gone, so say so right away as well.
+                msg = (
+                    f'unsupported type of OUT parameter {fp["name"]!r} of '
+                    f'{func["funcname"][0]["String"]["sval"]}: {pgtype}'
+                )
+                print(f'WARNING: {msg}', file=sys.stderr)
+                raise Exception(msg)
+            col = f'{col}::{widened}'
+        cols.append(col)
+
+    if not subtypes:
+        raise Exception('record without OUT parameters')
+
+    rettype = qlast.TypeName(
+        maintype=qlast.ObjectRef(name='tuple'),
+        subtypes=subtypes,
+    )
+    return rettype, ', '.join(cols)
+
+
+def get_return_type(func):
+    ret = func['returnType']
+    if ret['names'][-1]['String']['sval'] == 'record':
+        rettype, _ = get_record_type(func)
+    else:
+        rettype, _ = sql_to_eqltype(ret)
+
+    return rettype
+
+
 def convert_function_sig(eqlname, fname, func, is_strict, adapt_fns):
     params, callsig, needs_adapter = get_params(
-        func.get('parameters'), is_strict)
+        get_in_params(func), is_strict)
+    rettype = func['returnType']['names'][-1]['String']['sval']
 
-    if needs_adapter:
+    if rettype in COMPOSITE_TYPES:
+        # The rows need to be turned into tuples of EdgeDB types.
+        if (cols := COMPOSITE_TYPES[rettype]) is None:
+            _, cols = get_record_type(func)
+        code = qlast.FunctionCode(
+            language=qlast.Language.SQL,
+            code=f'SELECT {cols} FROM {fname}({", ".join(callsig)})',
+        )
+        adapt_fns.add(eqlname)
+    elif needs_adapter:
         code = qlast.FunctionCode(
             language=qlast.Language.SQL,
             code=f'SELECT {fname}({", ".join(callsig)})',
@@ -320,6 +506,82 @@ def convert_function_sig(eqlname, fname, func, is_strict, adapt_fns):
     return params, code
 
 
+def convert_window_sig(fname, func, is_strict):
+    # Window functions need to see the whole set of geometries at once, so
+    # they take an array of (id, geometry) tuples instead of the geometry and
+    # return the id of each input that is part of a cluster along with the
+    # cluster id.
+    params, callsig, _ = get_params(get_in_params(func), is_strict)
+
+    geomtype = params[0].type
+    if geomtype.maintype.name != 'geometry':
+        raise Exception(f'unsupported window function argument: {fname}')
+
+    params[0].name = 'items'
+    params[0].typemod = qltypes.TypeModifier.SingletonType
+    params[0].type = qlast.TypeName(
+        maintype=qlast.ObjectRef(name='array'),
+        subtypes=[
+            qlast.TypeName(
+                maintype=qlast.ObjectRef(name='tuple'),
+                subtypes=[
+                    qlast.TypeName(
+                        name='id',
+                        maintype=qlast.ObjectRef(name='uuid', module='std'),
+                    ),
+                    qlast.TypeName(
+                        name='geometry',
+                        maintype=geomtype.maintype,
+                    ),
+                ],
+            ),
+        ],
+    )
+    callsig[0] = 't.geometry'
+
+    rettype = qlast.TypeName(
+        maintype=qlast.ObjectRef(name='tuple'),
+        subtypes=[
+            qlast.TypeName(
+                name='id',
+                maintype=qlast.ObjectRef(name='uuid', module='std'),
+            ),
+            qlast.TypeName(
+                name='cluster_id',
+                maintype=qlast.ObjectRef(name='int64', module='std'),
+            ),
+        ],
+    )
+
+    # Inputs that don't belong to any cluster get a NULL cluster id, which
+    # cannot be part of a tuple, so they are left out.
+    code = qlast.FunctionCode(
+        language=qlast.Language.SQL,
+        code=(
+            f'SELECT q.id, q.cluster_id::int8 FROM ('
+            f'SELECT t.id, {fname}({", ".join(callsig)}) OVER () '
+            f'AS cluster_id FROM unnest("items") AS t(id, geometry)'
+            f') AS q WHERE q.cluster_id IS NOT NULL'
+        ),
+    )
+
+    return params, code, rettype
+
+
+def get_window_comment(comment, func):
+    # The PostGIS comments describe the window function arguments, but the
+    # reflected function takes the array of items instead of the geometry
+    # and isn't a window function itself.
+    args = ['items'] + [
+        p['FunctionParameter'].get('name', f'a{i}')
+        for i, p in enumerate(get_in_params(func)) if i > 0
+    ]
+    _, _, desc = comment.partition(' - ')
+    desc = re.sub(r'^Window function that r', 'R', desc)
+
+    return f'args: {", ".join(args)} - {desc}'
+
+
 def screen_name(name):
     # We want to rename our EdgeDB functions, sometimes to drop the "st"
     # prefix, other times because we have specific naming convention for
@@ -368,10 +630,25 @@ def compare_sql_defs(def0, def1):
         return True
 
 
+class FuncOptions(typing.NamedTuple):
+    volatility: str
+    is_strict: bool
+    is_window: bool
+    # Name of the planner support function, if any.
+    support: str | None
+    # One of 'safe', 'restricted' or 'unsafe'.
+    parallel: str
+    # Planner cost estimate, if not the default one.
+    cost: float | None
+
+
 def get_options(func):
     volatility = 'Volatile'
     is_strict = False
     is_window = False
+    support = None
+    parallel = 'unsafe'
+    cost = None
 
     for opt in func['options']:
         if opt['DefElem']['defname'] == 'volatility':
@@ -380,16 +657,65 @@ def get_options(func):
             is_strict = opt['DefElem']['arg']['Boolean']['boolval']
         elif opt['DefElem']['defname'] == 'window':
             is_window = opt['DefElem']['arg']['Boolean']['boolval']
-
-    return volatility, is_strict, is_window
-
-
-def get_comment(name, func, comments):
-    # Given a SQL function find the corresponding comment based on signature.
+        elif opt['DefElem']['defname'] == 'support':
+            _el = opt['DefElem']['arg']['List']['items'][-1]
+            support = _el['String']['sval']
+        elif opt['DefElem']['defname'] == 'parallel':
+            parallel = opt['DefElem']['arg']['String']['sval'].lower()
+        elif opt['DefElem']['defname'] == 'cost':
+            arg = opt['DefElem']['arg']
+            if 'Integer' in arg:
+                cost = float(arg['Integer'].get('ival', 0))
+            else:
+                cost = float(arg['Float']['fval'])
+
+    return FuncOptions(
+        volatility, is_strict, is_window, support, parallel, cost)
+
+
+def get_signature_key(params):
+    # Normalize a list of FunctionParameter nodes into a hashable key that
+    # identifies the signature: type names, array bounds and parameter mode.
+    # Parameter names and defaults are ignored, since comments don't have
+    # them.
+    key = []
+    for p in params or []:
+        fp = p['FunctionParameter']
+        argtype = fp['argType']
+        key.append((
+            tuple(n['String']['sval'] for n in argtype['names']),
+            tuple(
+                b['Integer'].get('ival', 0)
+                for b in argtype.get('arrayBounds', [])
+            ),
+            fp.get('mode'),
+        ))
+
+    return tuple(key)
+
+
+def index_comments(comments):
+    # Map function names and signature keys onto the comment text. The first
+    # matching comment wins, same as with a linear scan.
+    index = {}
+    for name, comm_list in comments.items():
+        sigs = index.setdefault(name, {})
+        for comm in comm_list:
+            key = get_signature_key(
+                comm['object']['ObjectWithArgs'].get('objfuncargs', []))
+            sigs.setdefault(key, comm['comment'])
+
+    return index
+
+
+def scan_comment(name, params, comments):
+    # Given a SQL function find the corresponding comment based on signature
+    # by comparing the parameter trees directly. This is slow, so it's only
+    # used for cross-checking the comment index.
     for comm in comments.get(name, []):
 
         if compare_sql_defs(
-            func.get('parameters', []),
+            params,
             comm['object']['ObjectWithArgs'].get('objfuncargs', []),
         ):
             return comm['comment']
@@ -397,53 +723,178 @@ def get_comment(name, func, comments):
     return None
 
 
+def get_comment(name, params, comments, comment_index):
+    # Given a SQL function find the corresponding comment based on signature.
+    comment = comment_index.get(name, {}).get(get_signature_key(params))
+
+    if DEBUG_COMMENTS:
+        expected = scan_comment(name, params, comments)
+        if comment != expected:
+            print(
+                f'WARNING: comment lookup mismatch for {name}: '
+                f'{comment!r} != {expected!r}',
+                file=sys.stderr,
+            )
+
+    return comment
+
+
+def get_parser_version():
+    # The parsed AST depends on the exact pg_parse build, so we use the hash
+    # of the compiled parser module as its version.
+    with open(pgparser.__file__, mode='rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def parse_sql_file(fpath, cache_dir=None, parser_version=None):
+    '''Parse a PostGIS SQL file into a list of relevant statements.
+
+    Only the CreateFunctionStmt, DefineStmt and CommentStmt nodes are kept.
+    If *cache_dir* is given, the result is cached there keyed by the hash of
+    the file contents and the parser version.
+    '''
+
+    with open(fpath, mode='rt') as f:
+        sql_query = ''.join(
+            line for line in f.readlines()
+            if not line.startswith('\\')
+        )
+
+    cache_path = None
+    if cache_dir is not None:
+        # Different PostGIS versions have files with the same name, so the
+        # cache entries are also distinguished by the full path.
+        stem = hashlib.sha256(str(fpath).encode()).hexdigest()[:16]
+        stem = f'{fpath.name}.{stem}'
+        key = hashlib.sha256()
+        key.update(f'{PARSE_CACHE_VERSION}:{parser_version}:'.encode())
+        key.update(sql_query.encode())
+        cache_path = cache_dir / f'{stem}.{key.hexdigest()}.pickle'
+
+        if cache_path.exists():
+            with open(cache_path, mode='rb') as f:
+                return pickle.load(f)
+
+    stmts = []
+    ast_json = pg_parse(bytes(sql_query, encoding="UTF8"))
+    for code in json.loads(ast_json)['stmts']:
+        if (stmt := code.get('stmt')) and (
+            'DefineStmt' in stmt
+            or 'CreateFunctionStmt' in stmt
+            or 'CommentStmt' in stmt
+        ):
+            stmts.append(stmt)
+
+    if cache_path is not None:
+        # Stale entries for the same file are no longer useful.
+        for old in cache_dir.glob(f'{stem}.*.pickle'):
+            old.unlink()
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.tmp')
+        with open(tmp_path, mode='wb') as f:
+            pickle.dump(stmts, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    return stmts
+
+
 def parse_postgis_extension(
-    path, functions, aggregates, comments, aggcomments, operators
+    path, version, functions, aggregates, comments, aggcomments, operators,
+    cache_dir=None,
 ):
     root = pathlib.Path(path).resolve()
+    parser_version = get_parser_version() if cache_dir is not None else None
     for fpath in root.glob('**/postgis*.sql'):
         name = fpath.name
         # We might scan more postgis extension files
-        if name in {'postgis--3.5.1.sql', 'postgis_comments.sql'}:
-            with open(fpath, mode='rt') as f:
-                sql_query = ''.join(
-                    line for line in f.readlines()
-                    if not line.startswith('\\')
-                )
-                ast_json = pg_parse(bytes(sql_query, encoding="UTF8"))
-                for code in json.loads(ast_json)['stmts']:
-                    if 'stmt' in code:
-                        stmt = code['stmt']
-
-                        if defn := stmt.get('DefineStmt'):
-                            if defn['kind'] == 'OBJECT_OPERATOR':
-                                operators.append(defn)
-                            elif defn['kind'] == 'OBJECT_AGGREGATE':
-                                _el = defn['defnames'][0]
-                                name = _el['String']['sval']
-                                aggregates[name].append(defn)
-
-                        elif func := stmt.get('CreateFunctionStmt'):
-                            name = func['funcname'][0]['String']['sval']
-                            functions[name].append(func)
-
-                        elif comm := stmt.get('CommentStmt'):
-                            if comm['objtype'] == 'OBJECT_FUNCTION':
-                                _o = comm['object']['ObjectWithArgs']
-                                name = _o['objname'][0]['String']['sval']
-                                comments[name].append(comm)
-                            elif comm['objtype'] == 'OBJECT_AGGREGATE':
-                                _o = comm['object']['ObjectWithArgs']
-                                name = _o['objname'][0]['String']['sval']
-                                aggcomments[name].append(comm)
+        if name in {f'postgis--{version}.sql', 'postgis_comments.sql'}:
+            stmts = parse_sql_file(fpath, cache_dir, parser_version)
+            for stmt in stmts:
+                if defn := stmt.get('DefineStmt'):
+                    if defn['kind'] == 'OBJECT_OPERATOR':
+                        operators.append(defn)
+                    elif defn['kind'] == 'OBJECT_AGGREGATE':
+                        _el = defn['defnames'][0]
+                        name = _el['String']['sval']
+                        aggregates[name].append(defn)
+
+                elif func := stmt.get('CreateFunctionStmt'):
+                    name = func['funcname'][0]['String']['sval']
+                    functions[name].append(func)
+
+                elif comm := stmt.get('CommentStmt'):
+                    if comm['objtype'] == 'OBJECT_FUNCTION':
+                        _o = comm['object']['ObjectWithArgs']
+                        name = _o['objname'][0]['String']['sval']
+                        comments[name].append(comm)
+                    elif comm['objtype'] == 'OBJECT_AGGREGATE':
+                        _o = comm['object']['ObjectWithArgs']
+                        name = _o['objname'][0]['String']['sval']
+                        aggcomments[name].append(comm)
+
+
+def get_op_info(op):
+    # Extract the argument types, procedure and selectivity estimators from
+    # an operator definition.
+    info = {}
+    for defn in op['definition']:
+        el = defn['DefElem']
+        if el['defname'] in {
+            'leftarg', 'rightarg', 'procedure', 'restrict', 'join'
+        }:
+            _el = el['arg']['TypeName']['names'][-1]
+            info[el['defname']] = _el['String']['sval']
+
+    return info
+
+
+def check_op_estimators(name, info, op_infos):
+    # The operator wrappers call the operator with the arguments of the
+    # EdgeDB types, so if those don't match the operator argument types
+    # exactly, the call may resolve to a different operator. In that case we
+    # need to make sure that the operator that is actually used has the same
+    # selectivity estimators.
+    args = tuple(
+        CALL_TYPES.get(info.get(arg), info.get(arg))
+        for arg in ['leftarg', 'rightarg']
+    )
+    if args == (info.get('leftarg'), info.get('rightarg')):
+        return
+
+    actual = op_infos.get((name, *args))
+    if actual is None:
+        print(
+            f'WARNING: operator {name}{args} that {info["procedure"]} '
+            f'resolves to does not exist',
+            file=sys.stderr,
+        )
+    elif (
+        (actual.get('restrict'), actual.get('join'))
+        != (info.get('restrict'), info.get('join'))
+    ):
+        print(
+            f'WARNING: {info["procedure"]} resolves to operator {name}{args} '
+            f'which uses {actual.get("restrict")}/{actual.get("join")} '
+            f'estimators instead of {info.get("restrict")}/'
+            f'{info.get("join")}',
+            file=sys.stderr,
+        )
 
 
 def generate_eqlop(operators, functions):
     eqlop = []
+    op_infos = {}
+    for op in operators:
+        info = get_op_info(op)
+        name = op['defnames'][0]['String']['sval']
+        op_infos[(name, info.get('leftarg'), info.get('rightarg'))] = info
+
     for op in operators:
         name = op['defnames'][0]['String']['sval']
         if name not in {'<', '<=', '>', '>=', '='}:
             try:
+                check_op_estimators(name, get_op_info(op), op_infos)
+
                 for defn in op['definition']:
 
                     el = defn['DefElem']
@@ -458,7 +909,7 @@ def generate_eqlop(operators, functions):
                 # For most operators there is only one function, but when there
                 # are multiple they have the same return type.
                 func = functions[fname][0]
-                volatility, _, _ = get_options(func)
+                volatility = get_options(func).volatility
 
                 eqlname = fname
                 if eqlname.startswith('geo'):
@@ -517,28 +968,46 @@ def generate_eqlop(operators, functions):
 def generate_eqlfunc(functions, comments):
     eqlfunc = []
     adapt_fns = set()
+    inline_fns = set()
+    comment_index = index_comments(comments)
 
     for key, func_list in functions.items():
         for func in func_list:
             try:
-                volatility, is_strict, is_window = get_options(func)
+                opts = get_options(func)
+                volatility, is_strict, is_window = opts[:3]
 
-                if is_window:
-                    # skip window functions for now
+                if is_window and not key.startswith('st_cluster'):
+                    # skip other window functions for now
                     continue
 
                 eqlname = screen_name(key)
+                if (
+                    opts.support
+                    or opts.parallel == 'safe'
+                    or opts.cost is not None
+                ):
+                    # The planner support function rewrites calls into
+                    # index-able expressions, while parallel safety and cost
+                    # affect the plans the planner considers. All of these
+                    # are lost unless the PostGIS function itself ends up in
+                    # the query, so we need to keep track of these.
+                    inline_fns.add(eqlname)
                 commands = [
                     qlast.SetField(
                         name='volatility',
                         value=qlast.Constant.string(volatility),
                     ),
-                    qlast.SetField(
+                ]
+                if not is_window and needs_return_cast(func['returnType']):
+                    commands.append(qlast.SetField(
                         name='force_return_cast',
                         value=qlast.Constant.boolean(True),
-                    ),
-                ]
-                comment = get_comment(key, func, comments)
+                    ))
+                comment = get_comment(
+                    key, get_in_params(func), comments, comment_index)
+                if comment and is_window:
+                    comment = get_window_comment(comment, func)
                 if comment:
                     commands.append(qlast.CreateAnnotationValue(
                         name=qlast.ObjectRef(
@@ -547,32 +1016,42 @@ def generate_eqlfunc(functions, comments):
                         value=qlast.Constant.string(comment),
                     ))
 
-                if not is_strict:
+                if not is_strict or is_window:
                     commands.append(qlast.SetField(
                         name='impl_is_strict',
                         value=qlast.Constant.boolean(False),
                     ))
 
-                params, code = convert_function_sig(
-                    eqlname, key, func, is_strict, adapt_fns)
-                rettype, _ = sql_to_eqltype(func['returnType'])
-
-                if (
-                    eqlname in {'to_geometry', 'to_geography'}
-                    and len(params) > 1
-                ):
-                    # We only care about converter functions that take a
-                    # single argument here. Other casting functions take
-                    # typemod indicating a geometry or geography subtype which
-                    # we don't currently support. If and when we would support
-                    # that, we'd expose them in a custom way using enums
-                    # rather than integer codes.
-                    continue
-
-                if not is_strict or eqlname in OPT_RETURN_FUNC:
-                    returning_typemod = qltypes.TypeModifier.OptionalType
+                if is_window:
+                    params, code, rettype = convert_window_sig(
+                        key, func, is_strict)
+                    returning_typemod = qltypes.TypeModifier.SetOfType
                 else:
-                    returning_typemod = qltypes.TypeModifier.SingletonType
+                    params, code = convert_function_sig(
+                        eqlname, key, func, is_strict, adapt_fns)
+                    rettype = get_return_type(func)
+
+                    if (
+                        eqlname in {'to_geometry', 'to_geography'}
+                        and len(params) > 1
+                    ):
+                        # We only care about converter functions that take a
+                        # single argument here. Other casting functions take
+                        # typemod indicating a geometry or geography subtype
+                        # which we don't currently support. If and when we
+                        # would support that, we'd expose them in a custom way
+                        # using enums rather than integer codes.
+                        continue
+
+                    if func['returnType'].get('setof'):
+                        # RETURNS SETOF ...
+                        returning_typemod = qltypes.TypeModifier.SetOfType
+                    elif not is_strict or eqlname in OPT_RETURN_FUNC:
+                        returning_typemod = (
+                            qltypes.TypeModifier.OptionalType)
+                    else:
+                        returning_typemod = (
+                            qltypes.TypeModifier.SingletonType)
 
                 ef = qlast.CreateFunction(
                     name=qlast.ObjectRef(
@@ -590,17 +1069,89 @@ def generate_eqlfunc(functions, comments):
             except Exception as e:
                 record_broken(key, func, e)
 
-    return eqlfunc, adapt_fns
+    return eqlfunc, adapt_fns, inline_fns
+
+
+class AggOptions(typing.NamedTuple):
+    stype: dict
+    finalfunc: str | None
+    combinefunc: str | None
+    serialfunc: str | None
+    deserialfunc: str | None
+    # One of 'safe', 'restricted' or 'unsafe'.
+    parallel: str
+
+
+def get_agg_options(func):
+    opts = {}
+    parallel = 'unsafe'
+
+    for el in func['definition']:
+        defel = el['DefElem']
+        name = defel['defname'].lower()
+        if name == 'stype':
+            opts[name] = defel['arg']['TypeName']
+        elif name in {
+            'finalfunc', 'combinefunc', 'serialfunc', 'deserialfunc'
+        }:
+            _el = defel['arg']['TypeName']['names'][-1]
+            opts[name] = _el['String']['sval']
+        elif name == 'parallel':
+            arg = defel['arg']
+            if 'TypeName' in arg:
+                _el = arg['TypeName']['names'][-1]
+                parallel = _el['String']['sval'].lower()
+            else:
+                parallel = arg['String']['sval'].lower()
+
+    return AggOptions(
+        opts['stype'],
+        opts.get('finalfunc'),
+        opts.get('combinefunc'),
+        opts.get('serialfunc'),
+        opts.get('deserialfunc'),
+        parallel,
+    )
+
+
+def check_agg_parallel(name, opts):
+    # Partial aggregation needs the aggregate to be parallel safe and to have
+    # a combine function. Aggregates with an internal state additionally
+    # need to be able to (de)serialize it to pass it between workers.
+    #
+    # The aggregates are called directly, so Postgres picks this up from the
+    # PostGIS definition. This only points out the ones that can't use it.
+    stype = opts.stype['names'][-1]['String']['sval']
+    if opts.parallel != 'safe':
+        reason = f'parallel {opts.parallel}'
+    elif opts.combinefunc is None:
+        reason = 'no combine function'
+    elif stype == 'internal' and (
+        opts.serialfunc is None or opts.deserialfunc is None
+    ):
+        reason = 'no serialization functions'
+    else:
+        return True
+
+    print(
+        f'NOTE: aggregate {name} cannot use partial aggregation: {reason}',
+        file=sys.stderr,
+    )
+    return False
 
 
 def generate_eqlagg(aggregates, functions, comments):
     eqlagg = []
+    comment_index = index_comments(comments)
     for key, agg_list in aggregates.items():
         for func in agg_list:
             try:
                 eqlname = f'{screen_name(key)}_agg'
 
-                comment = get_comment(key, func, comments)
+                # Aggregates are looked up with an empty parameter list,
+                # same as before the comment index, which is what the
+                # generated files reflect.
+                comment = get_comment(key, [], comments, comment_index)
                 if not comment:
                     continue
 
@@ -609,10 +1160,6 @@ def generate_eqlagg(aggregates, functions, comments):
                         name='volatility',
                         value=qlast.Constant.string('Immutable'),
                     ),
-                    qlast.SetField(
-                        name='force_return_cast',
-                        value=qlast.Constant.boolean(True),
-                    ),
                     qlast.CreateAnnotationValue(
                         name=qlast.ObjectRef(
                             name='description',
@@ -629,14 +1176,20 @@ def generate_eqlagg(aggregates, functions, comments):
                     from_function=key,
                 )
 
-                for el in func['definition']:
-                    defel = el['DefElem']
-                    if defel['defname'] == 'finalfunc':
-                        _el = defel['arg']['TypeName']['names'][0]
-                        ffname = _el['String']['sval']
-                        ffunc = functions[ffname][0]
-                        rettype, _ = sql_to_eqltype(ffunc['returnType'])
-                        break
+                opts = get_agg_options(func)
+                check_agg_parallel(key, opts)
+
+                # Without a final function the aggregate returns its state.
+                if opts.finalfunc is not None:
+                    ret = functions[opts.finalfunc][0]['returnType']
+                else:
+                    ret = opts.stype
+                rettype, _ = sql_to_eqltype(ret)
+                if needs_return_cast(ret):
+                    commands.insert(1, qlast.SetField(
+                        name='force_return_cast',
+                        value=qlast.Constant.boolean(True),
+                    ))
 
                 ef = qlast.CreateFunction(
                     name=qlast.ObjectRef(
@@ -716,8 +1269,12 @@ def get_sql_name(eqldef):
     if eqldef.code.from_function:
         return eqldef.code.from_function
     else:
-        return re.match(
-            r'SELECT (\w+)', eqldef.code.code).group(1)
+        # The first function called in the SQL body, operators don't call
+        # any.
+        if match := re.search(r'(\w+)\(', eqldef.code.code):
+            return match.group(1)
+        else:
+            return None
 
 
 def get_func_categories(eqlfunc):
@@ -758,13 +1315,196 @@ def rst_make_body(text):
         return f'\n{body}'
 
 
-def rst_print_functions(func_dict, func_docs, is_operator=False, file=None):
+def generate_sources(eqldefs, *, jobs=1, **kwargs):
+    '''Generate the EdgeQL source for every definition.
+
+    With more than one job the work is split across a process pool. The
+    results are always returned in the same order as *eqldefs*.
+    '''
+
+    gen = functools.partial(qlcodegen.generate_source, **kwargs)
+    if jobs > 1 and len(eqldefs) > 1:
+        chunksize = max(1, len(eqldefs) // (jobs * 4))
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(gen, eqldefs, chunksize=chunksize))
+    else:
+        return [gen(ef) for ef in eqldefs]
+
+
+def get_typename(atype):
+    name = atype.maintype.name
+    if atype.maintype.module:
+        name = f'{atype.maintype.module}::{name}'
+    if atype.subtypes:
+        name += f'<{", ".join(get_typename(st) for st in atype.subtypes)}>'
+
+    return name
+
+
+def get_def_key(ef):
+    # Identify a definition by its name and parameter types, which stays the
+    # same across runs even if the overloads get reordered.
+    params = ', '.join(get_typename(p.type) for p in ef.params)
+    return f'{ef.name.name}({params})'
+
+
+def get_def_keys(eqldefs):
+    keys = []
+    seen = set()
+    for ef in eqldefs:
+        key = base = get_def_key(ef)
+        n = 1
+        while key in seen:
+            n += 1
+            key = f'{base}#{n}'
+        seen.add(key)
+        keys.append(key)
+
+    return keys
+
+
+def dump_node(node):
+    '''Dump a generated definition into plain data that can be hashed.
+
+    Only the fields of the nodes are dumped, not the metadata such as
+    spans, so the same definition always produces the same dump.
+    '''
+
+    if isinstance(node, astbase.AST):
+        return [type(node).__name__, {
+            name: dump_node(val)
+            for name, val in astbase.iter_fields(node, include_meta=False)
+        }]
+    elif isinstance(node, (list, tuple)):
+        return [dump_node(val) for val in node]
+    elif isinstance(node, dict):
+        return {str(key): dump_node(val) for key, val in node.items()}
+    else:
+        return node
+
+
+def get_node_key(node):
+    return hashlib.sha256(
+        json.dumps(dump_node(node), sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_generator_version():
+    # The rendered sources only depend on the definitions themselves and the
+    # way the codegen turns them into text.
+    with open(qlcodegen.__file__, mode='rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def render_definitions(eqldefs, manifest_path=None, jobs=1):
+    '''Render the .edgeql and .rst sources of all definitions.
+
+    The manifest from the previous run maps every definition onto a
+    fingerprint of its generated AST and keeps the rendered sources. Only
+    definitions that are new or have changed get rendered again, but the
+    output files themselves are always assembled in full.
+
+    Returns a pair of dicts mapping id() of the definitions onto the
+    .edgeql and .rst sources respectively.
+    '''
+
+    old_defs = {}
+    old_sources = {}
+    if manifest_path is not None and manifest_path.exists():
+        with open(manifest_path, mode='rb') as f:
+            manifest = pickle.load(f)
+        old_defs = manifest['defs']
+        old_sources = manifest['sources']
+
+    version = get_generator_version()
+    defs = {}
+    render_keys = []
+    for ef, key in zip(eqldefs, get_def_keys(eqldefs)):
+        defs[key] = get_node_key(ef)
+        render_keys.append(hashlib.sha256(
+            f'{version}:{defs[key]}'.encode()).hexdigest())
+
+    missing = {}
+    for ef, rkey in zip(eqldefs, render_keys):
+        if rkey not in old_sources:
+            missing.setdefault(rkey, ef)
+    rendered = zip(
+        missing.keys(),
+        generate_sources(list(missing.values()), jobs=jobs, pretty=True),
+        generate_sources(list(missing.values()), jobs=jobs),
+    )
+
+    sources = {rkey: old_sources[rkey] for rkey in render_keys
+               if rkey in old_sources}
+    for rkey, eql_src, rst_src in rendered:
+        sources[rkey] = (eql_src, rst_src)
+
+    if manifest_path is not None:
+        added = defs.keys() - old_defs.keys()
+        removed = old_defs.keys() - defs.keys()
+        changed = {
+            key for key in defs.keys() & old_defs.keys()
+            if defs[key] != old_defs[key]
+        }
+        print(
+            f'definitions: {len(added)} added, {len(changed)} changed, '
+            f'{len(removed)} removed, {len(missing)} rendered'
+        )
+        for label, keys in [('+', added), ('~', changed), ('-', removed)]:
+            for key in sorted(keys):
+                print(f'  {label} {key}')
+
+        os.makedirs(manifest_path.parent, exist_ok=True)
+        with open(manifest_path, mode='wb') as f:
+            pickle.dump(
+                {'defs': defs, 'sources': sources},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+    return (
+        {id(ef): sources[rkey][0] for ef, rkey in zip(eqldefs, render_keys)},
+        {id(ef): sources[rkey][1] for ef, rkey in zip(eqldefs, render_keys)},
+    )
+
+
+def split_params(params):
+    # Split the parameters at the commas between them, but not at the ones
+    # in types such as tuple<a: int64, b: str> or in string defaults.
+    res = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, c in enumerate(params):
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in {"'", '"'}:
+            quote = c
+        elif c == '<':
+            depth += 1
+        elif c == '>':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            res.append(params[start:i])
+            start = i + 1
+    res.append(params[start:])
+
+    return res
+
+
+def rst_print_functions(
+    func_dict, func_docs, is_operator=False, file=None, sources=None
+):
     prev_name = ''
     for _, func_list in sorted(func_dict.items(), key=lambda x: x[0]):
         func_sigs = []
         # Also sort the grouped functions by length of signature
         for ef in func_list:
-            code = qlcodegen.generate_source(ef)
+            if sources is not None:
+                code = sources[id(ef)]
+            else:
+                code = qlcodegen.generate_source(ef)
             name, params, ret = re.match(r'''(?x)
                 create\sfunction\s
                 ([\w:]+)
@@ -782,8 +1522,8 @@ def rst_print_functions(func_dict, func_docs, is_operator=False, file=None):
             else:
                 print(f'{SIGINDENT}{name}( \\', file=file)
 
-            if ',' in params:
-                for param in params.split(','):
+            if len(param_list := split_params(params)) > 1:
+                for param in param_list:
                     print(f'{SIGINDENT}  {param.strip()}, \\', file=file)
             else:
                 print(f'{SIGINDENT}  {params.strip()} \\', file=file)
@@ -830,8 +1570,190 @@ def rst_print_categories(func_categories, file=None):
                 f'      - :eql:func-desc:`ext::postgis::{name}`\n', file=file)
 
 
-def main(show_broken=False):
-    base_build = pathlib.Path(__file__).parent.parent.resolve()
+def get_manifest_version(path):
+    with open(path, mode='rb') as f:
+        return tomllib.load(f)['version']
+
+
+# Values that function fields have when they aren't set explicitly.
+FUNCTION_FIELD_DEFAULTS = {
+    'volatility': qlast.Constant.string('Volatile'),
+    'impl_is_strict': qlast.Constant.boolean(True),
+    'force_return_cast': qlast.Constant.boolean(False),
+    'prefer_subquery_args': qlast.Constant.boolean(False),
+}
+
+
+def get_function_fields(ef):
+    fields = {}
+    description = None
+    for cmd in ef.commands:
+        if isinstance(cmd, qlast.SetField):
+            fields[cmd.name] = cmd.value
+        elif isinstance(cmd, qlast.CreateAnnotationValue):
+            description = cmd.value
+
+    return fields, description
+
+
+def get_alter_function(old_ef, new_ef):
+    '''Generate the DDL altering *old_ef* in place to become *new_ef*.
+
+    Both must have the same signature. Unlike dropping and re-creating the
+    function, this also works if something else depends on it, such as the
+    hand-written parts of the template.
+    '''
+
+    old_fields, old_desc = get_function_fields(old_ef)
+    new_fields, new_desc = get_function_fields(new_ef)
+
+    commands = []
+    for name, default in FUNCTION_FIELD_DEFAULTS.items():
+        old = old_fields.get(name, default)
+        new = new_fields.get(name, default)
+        if (
+            qlcodegen.generate_source(old)
+            != qlcodegen.generate_source(new)
+        ):
+            commands.append(qlast.SetField(name=name, value=new))
+
+    desc_ref = qlast.ObjectRef(name='description')
+    if old_desc is not None and new_desc is None:
+        commands.append(qlast.DropAnnotationValue(name=desc_ref))
+    elif old_desc is None and new_desc is not None:
+        commands.append(
+            qlast.CreateAnnotationValue(name=desc_ref, value=new_desc))
+    elif old_desc is not None and (
+        qlcodegen.generate_source(old_desc)
+        != qlcodegen.generate_source(new_desc)
+    ):
+        commands.append(
+            qlast.AlterAnnotationValue(name=desc_ref, value=new_desc))
+
+    if (
+        old_ef.code.from_function != new_ef.code.from_function
+        or old_ef.code.code != new_ef.code.code
+    ):
+        code = new_ef.code
+    else:
+        code = qlast.FunctionCode()
+
+    return qlast.AlterFunction(
+        name=new_ef.name,
+        params=new_ef.params,
+        commands=commands,
+        code=code,
+    )
+
+
+def get_template_deps(template):
+    # The names of the reflected functions that the hand-written parts of the
+    # template call. Those cannot be dropped without dropping whatever uses
+    # them first.
+    return set(re.findall(r'ext::postgis::(\w+)\(', template))
+
+
+def render_template(template, version):
+    # The package version in the template comes from MANIFEST.toml.
+    return template.replace('@VERSION@', version)
+
+
+def read_package_defs(path, template, version):
+    '''Read the reflected definitions back from a generated package file.
+
+    The package in *path* must be of the given *version*. The functions
+    defined by the hand-written parts of the *template* are left out, so
+    only the reflected operators, functions and aggregates are returned.
+    '''
+
+    with open(path, mode='rt') as f:
+        package = qlparser.parse_block(f.read())[0]
+    if package.version.value != version:
+        raise Exception(
+            f'cannot generate the migration, {path} is the package for '
+            f'version {package.version.value}, not {version}'
+        )
+
+    hand_written = {
+        get_def_key(cmd)
+        for cmd in qlparser.parse_block(
+            render_template(template, version))[0].body.commands
+        if isinstance(cmd, qlast.CreateFunction)
+    }
+    return [
+        cmd for cmd in package.body.commands
+        if isinstance(cmd, qlast.CreateFunction)
+        and get_def_key(cmd) not in hand_written
+    ]
+
+
+def generate_migration(
+    old_defs, new_defs, new_sources, template_deps=frozenset(), jobs=1,
+):
+    '''Generate the DDL to go from the *old_defs* to the *new_defs*.
+
+    Functions that keep their signature are altered in place. Functions
+    that were removed or whose signature changed are dropped first, then
+    the added ones and the new versions of the changed ones are created.
+    Everything else is left alone.
+
+    Functions in *template_deps* are used by the hand-written parts of the
+    template, so if they would have to be dropped an exception is raised.
+    '''
+
+    old_sources = dict(zip(
+        get_def_keys(old_defs),
+        zip(old_defs, generate_sources(old_defs, jobs=jobs, pretty=True)),
+    ))
+    new_keys = get_def_keys(new_defs)
+
+    drops = []
+    alters = []
+    creates = []
+    for key, ef in zip(new_keys, new_defs):
+        if key not in old_sources:
+            creates.append(ef)
+        else:
+            old_ef, old_src = old_sources[key]
+            new_src = new_sources[id(ef)]
+            if old_src == new_src:
+                continue
+            # The first line is the whole signature: name, parameters with
+            # their defaults and the return type.
+            if old_src.splitlines()[0] == new_src.splitlines()[0]:
+                alters.append(get_alter_function(old_ef, ef))
+            else:
+                drops.append(old_ef)
+                creates.append(ef)
+
+    new_keys = set(new_keys)
+    for key, (old_ef, _) in old_sources.items():
+        if key not in new_keys:
+            drops.append(old_ef)
+
+    if blocked := sorted({ef.name.name for ef in drops} & template_deps):
+        raise Exception(
+            f'cannot generate the migration, the signature of functions '
+            f'used in postgis.template.edgeql changed: {", ".join(blocked)}'
+        )
+
+    ddl = [
+        qlast.DropFunction(name=ef.name, params=ef.params)
+        for ef in drops
+    ] + alters
+    return (
+        [qlcodegen.generate_source(cmd, pretty=True) for cmd in ddl]
+        + [new_sources[id(ef)] for ef in creates]
+    ), len(drops), len(alters), len(creates)
+
+
+def reflect_extension(path, version, cache_dir=None):
+    '''Reflect the PostGIS extension SQL files found in *path*.
+
+    Returns the lists of generated operator, function and aggregate
+    definitions.
+    '''
+
     # Used to generate both .edgeql and .rst
     functions = collections.defaultdict(list)
     aggregates = collections.defaultdict(list)
@@ -839,16 +1761,14 @@ def main(show_broken=False):
     aggcomments = collections.defaultdict(list)
     operators = []
 
-    # We're looking for the SQL files in the build location. This requires the
-    # build to be already done.
-    parse_postgis_extension(
-        base_build / 'build' / 'postgis--3.5.1' / 'share' / 'postgresql',
-        functions, aggregates, comments, aggcomments, operators,
-    )
-    eqlop = generate_eqlop(operators, functions)
-
-    # Specific for .rst
-    func_docs = read_xml(base_build / 'postgis' / 'src' / 'doc')
+    with profile_phase('SQL parse'):
+        parse_postgis_extension(
+            path, version,
+            functions, aggregates, comments, aggcomments, operators,
+            cache_dir=cache_dir,
+        )
+    with profile_phase('operator generation'):
+        eqlop = generate_eqlop(operators, functions)
 
     # remove functions corresponding to operators
     for op in operators:
@@ -893,8 +1813,69 @@ def main(show_broken=False):
             # skip functions we're not reflecting
             del functions[name]
 
-    eqlfunc, adapt_fns = generate_eqlfunc(functions, comments)
-    eqlagg = generate_eqlagg(aggregates, functions, aggcomments)
+    with profile_phase('function generation'):
+        eqlfunc, adapt_fns, inline_fns = generate_eqlfunc(
+            functions, comments)
+    with profile_phase('aggregate generation'):
+        eqlagg = generate_eqlagg(aggregates, functions, aggcomments)
+
+    # Review all generated functions to make sure that the way they are
+    # implemented is consistent across overloaded variants. EdgeDB only
+    # allows overloading 'using sql function' functions if all of them
+    # point to the same SQL function, so once one overload needs an SQL
+    # wrapper, e.g. `buffer(geometry, float64, int64)` for its int4
+    # parameter, the others such as `buffer(geography, float64)` must be
+    # wrapped as well, even though they need no adapter. The wrappers are
+    # inlined by Postgres (see below), so the plain ones cost no more than
+    # a direct call; bench_casts.py compares `point(x, y)` with
+    # `makepoint(x, y)` to check that.
+    for func in eqlfunc:
+        if func.name.name in adapt_fns:
+            code = func.code
+            if code.from_function is not None:
+                # fix this by rewriting the call as 'SELECT ...'
+                sig = ', '.join(f'"{p.name}"' for p in func.params)
+                code.code = f'SELECT {code.from_function}({sig})'
+                code.from_function = None
+
+    # Planner support functions, parallel safety and cost of the PostGIS
+    # functions only apply if they are called directly. If they had to be
+    # wrapped into SQL, the wrapper must be inlined and Postgres only manages
+    # to inline it if it isn't marked strict.
+    for func in eqlfunc:
+        if func.name.name in inline_fns and func.code.from_function is None:
+            if not any(
+                isinstance(cmd, qlast.SetField)
+                and cmd.name == 'impl_is_strict'
+                for cmd in func.commands
+            ):
+                func.commands.append(qlast.SetField(
+                    name='impl_is_strict',
+                    value=qlast.Constant.boolean(False),
+                ))
+
+    return eqlop, eqlfunc, eqlagg
+
+
+def main(show_broken=False, use_cache=True, jobs=1, upgrade_from=None):
+    base_build = pathlib.Path(__file__).parent.parent.resolve()
+    cache_dir = (
+        base_build / 'build' / 'gen_ext_postgis_cache'
+        if use_cache else None
+    )
+    version = get_manifest_version(base_build / 'MANIFEST.toml')
+
+    # We're looking for the SQL files in the build location. This requires the
+    # build to be already done.
+    eqlop, eqlfunc, eqlagg = reflect_extension(
+        base_build / 'build' / f'postgis--{version}' / 'share' / 'postgresql',
+        version,
+        cache_dir=cache_dir,
+    )
+
+    # Specific for .rst
+    with profile_phase('XML docs'):
+        func_docs = read_xml(base_build / 'postgis' / 'src' / 'doc')
 
     if show_broken:
         # output all the broken functions instead of the extension
@@ -908,16 +1889,18 @@ def main(show_broken=False):
                     print(e, '\n')
         sys.exit(1)
 
-    # Review all generated functions to make sure that the way they are
-    # implemented is consistent across overloaded variants.
-    for func in eqlfunc:
-        if func.name.name in adapt_fns:
-            code = func.code
-            if code.from_function is not None:
-                # fix this by rewriting the call as 'SELECT ...'
-                sig = ', '.join(f'"{p.name}"' for p in func.params)
-                code.code = f'SELECT {code.from_function}({sig})'
-                code.from_function = None
+    # Render all the definitions up front, reusing the unchanged ones from
+    # the previous run, so that writing the output files is just a matter of
+    # looking them up.
+    with profile_phase('codegen'):
+        eql_sources, rst_sources = render_definitions(
+            eqlop + eqlfunc + eqlagg,
+            manifest_path=(
+                cache_dir / 'manifest.pickle'
+                if cache_dir is not None else None
+            ),
+            jobs=jobs,
+        )
 
     # Create ext_postgis directory in `build` for output files for the
     # extension and the docs.
@@ -926,9 +1909,20 @@ def main(show_broken=False):
         os.makedirs(build_dir)
 
     cur_dir = pathlib.Path(__file__).parent
-    with open(cur_dir / 'postgis.template.edgeql', mode='rt') as tf,\
+    with open(cur_dir / 'postgis.template.edgeql', mode='rt') as tf:
+        template = tf.read()
+
+    if upgrade_from is not None:
+        # The migration starts from the package that was generated for the
+        # old version, so read it back before it gets overwritten.
+        old_defs = read_package_defs(
+            build_dir / 'postgis.edgeql', template, upgrade_from)
+
+    with profile_phase('.edgeql rendering'),\
          open(build_dir / 'postgis.edgeql' , mode='wt') as out:
-        for line in tf.readlines():
+        for line in render_template(template, version).splitlines(
+            keepends=True
+        ):
             match line:
                 case '### REFLECT: OPERATORS\n':
                     text = (
@@ -948,9 +1942,7 @@ def main(show_broken=False):
                             "indexes work with it.",
                             '    ',
                         ), file=out)
-                        code = qlcodegen.generate_source(
-                            ef, pretty=True
-                        ).replace('\n;', ';\n')
+                        code = eql_sources[id(ef)].replace('\n;', ';\n')
                         print(textwrap.indent(f'{code};\n', '    '), file=out)
 
                 case '### REFLECT: FUNCTIONS\n':
@@ -964,8 +1956,7 @@ def main(show_broken=False):
                     print(textwrap.indent(text, '    '), file=out)
 
                     for ef in eqlfunc:
-                        code = qlcodegen.generate_source(
-                            ef, pretty=True).replace('\n;', ';\n')
+                        code = eql_sources[id(ef)].replace('\n;', ';\n')
                         print(textwrap.indent(f'{code};\n', '    '), file=out)
 
                 case '### REFLECT: AGGREGATES\n':
@@ -979,8 +1970,7 @@ def main(show_broken=False):
                     print(textwrap.indent(text, '    '), file=out)
 
                     for ef in eqlagg:
-                        code = qlcodegen.generate_source(
-                            ef, pretty=True).replace('\n;', ';\n')
+                        code = eql_sources[id(ef)].replace('\n;', ';\n')
                         print(textwrap.indent(f'{code};\n', '    '), file=out)
 
                 case _:
@@ -988,11 +1978,12 @@ def main(show_broken=False):
 
         print(f'writing {out.name}')
 
-    group_eqldef = get_group_eqldef(eqlop, eqlfunc, eqlagg)
-    func_categories = get_func_categories(eqlfunc)
-
-    with open(cur_dir / 'postgis.template.rst', mode='rt') as tf,\
+    with profile_phase('.rst rendering'),\
+         open(cur_dir / 'postgis.template.rst', mode='rt') as tf,\
          open(build_dir / 'postgis.rst' , mode='wt') as out:
+        group_eqldef = get_group_eqldef(eqlop, eqlfunc, eqlagg)
+        func_categories = get_func_categories(eqlfunc)
+
         for line in tf.readlines():
             match line:
                 case '.. REFLECT: OPERATORS\n':
@@ -1001,6 +1992,7 @@ def main(show_broken=False):
                         func_docs,
                         is_operator=True,
                         file=out,
+                        sources=rst_sources,
                     )
 
                 case '.. REFLECT: FUNCTIONS\n':
@@ -1008,6 +2000,7 @@ def main(show_broken=False):
                         group_eqldef['functions'],
                         func_docs,
                         file=out,
+                        sources=rst_sources,
                     )
 
                 case '.. REFLECT: AGGREGATES\n':
@@ -1015,6 +2008,7 @@ def main(show_broken=False):
                         group_eqldef['aggregates'],
                         func_docs,
                         file=out,
+                        sources=rst_sources,
                     )
 
                 case '.. REFLECT: CATEGORIES\n':
@@ -1028,17 +2022,93 @@ def main(show_broken=False):
 
         print(f'writing {out.name}')
 
+    if upgrade_from is not None:
+        # Only emit the differences between the old and the new package as
+        # a package migration.
+        with profile_phase('migration'):
+            ddl, ndrops, nalters, ncreates = generate_migration(
+                old_defs,
+                eqlop + eqlfunc + eqlagg,
+                eql_sources,
+                template_deps=get_template_deps(template),
+                jobs=jobs,
+            )
+
+        # The migrations are part of the package, see EXTRA_FILES in the
+        # Makefile.
+        mig_dir = base_build / 'build'
+        os.makedirs(mig_dir, exist_ok=True)
+        mig_name = f'postgis--{upgrade_from}--{version}.edgeql'
+        with open(mig_dir / mig_name, mode='wt') as out:
+            print(
+                f'create extension package migration postgis\n'
+                f'    from version \'{upgrade_from}\' '
+                f'to version \'{version}\'\n'
+                f'{{',
+                file=out,
+            )
+            text = (
+                f'# dropped functions: {ndrops}\n'
+                f'# altered functions: {nalters}\n'
+                f'# created functions: {ncreates}\n'
+                + '#' * 50 + '\n'
+            )
+            print(textwrap.indent(text, '    '), file=out)
+
+            for code in ddl:
+                code = code.replace('\n;', ';\n')
+                print(textwrap.indent(f'{code};\n', '    '), file=out)
+
+            print('};', file=out)
+
+            print(f'writing {out.name}')
+
+    if PROFILE is not None:
+        print_profile()
+
 
 @click.command('gen-ext-postgis')
 @click.option('--show-broken',
               type=click.Choice(['names', 'all'], case_sensitive=False))
-def gen_ext_postgis(*, show_broken):
+@click.option('--no-cache', is_flag=True,
+              help='Do not use the cached parsed PostGIS SQL files.')
+@click.option('--debug-comments', is_flag=True,
+              help='Cross-check comment lookup against the slow comparator.')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of processes used to render the definitions.')
+@click.option('--upgrade-from', metavar='VERSION',
+              help='Also generate a migration from this PostGIS version.')
+@click.option('--profile', is_flag=True,
+              help='Report time, peak RSS and object counts per phase.')
+@click.option('--profile-dump', type=click.Path(dir_okay=False),
+              help='Also write cProfile stats into this file.')
+def gen_ext_postgis(
+    *, show_broken, no_cache, debug_comments, jobs, upgrade_from, profile,
+    profile_dump,
+):
     """Generate ext::postgis extension file based on the installed PostGIS.
     """
+    global DEBUG_COMMENTS, PROFILE
+    DEBUG_COMMENTS = debug_comments
+    if profile or profile_dump:
+        PROFILE = []
+
+    profiler = cProfile.Profile() if profile_dump else None
     try:
-        main(show_broken=show_broken)
+        if profiler is not None:
+            profiler.enable()
+        main(
+            show_broken=show_broken,
+            use_cache=not no_cache,
+            jobs=jobs,
+            upgrade_from=upgrade_from,
+        )
     except Exception as ex:
         die(str(ex))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_dump)
 
 
 if __name__ == '__main__':
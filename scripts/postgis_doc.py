@@ -51,6 +51,34 @@ DESC_REWRITES = {
     the second geometry/geography. This is the first point of the 3D shortest
     line.
     """,
+    'st_clusterdbscan': """
+    Returns the cluster id of each geometry using the DBSCAN algorithm.
+
+    Takes an array of *(id, geometry)* tuples and returns an *(id,
+    cluster_id)* tuple for every input that is part of a cluster. Inputs that
+    are not part of any cluster are left out.
+    """,
+    'st_clusterintersectingwin': """
+    Returns the cluster id of each geometry, clustering into connected sets.
+
+    Takes an array of *(id, geometry)* tuples and returns an *(id,
+    cluster_id)* tuple for every input. Inputs that are not assigned a
+    cluster id are left out.
+    """,
+    'st_clusterkmeans': """
+    Returns the cluster id of each geometry using the K-means algorithm.
+
+    Takes an array of *(id, geometry)* tuples and returns an *(id,
+    cluster_id)* tuple for every input that is part of a cluster. Inputs with
+    empty geometries are left out.
+    """,
+    'st_clusterwithinwin': """
+    Returns the cluster id of each geometry, clustering by separation distance.
+
+    Takes an array of *(id, geometry)* tuples and returns an *(id,
+    cluster_id)* tuple for every input. Inputs that are not assigned a
+    cluster id are left out.
+    """,
     'st_containsproperly':
     """Tests if every point of *geom2* lies in the interior of *geom1*.""",
     'st_cpawithin': """
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+#
+# This source file is part of the EdgeDB open source project.
+#
+# Copyright 2024-present MagicStack Inc. and the EdgeDB authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""Serve Mapbox Vector Tiles straight from an ext::postgis database.
+
+Tiles are requested as ``/{layer}/{z}/{x}/{y}.mvt`` and encoded by the
+database using ``tileenvelope``, ``asmvtgeom`` and ``asmvt_agg``. Every
+layer is an object type with a geometry property, e.g.::
+
+    python scripts/tile_server.py --layer roads=default::Road.geometry
+
+Encoded tiles are kept in a bounded in-memory LRU for at most ``--max-age``
+seconds and concurrent requests for the same tile share a single query. The
+latency of each request is reported in the ``Server-Timing`` header and
+aggregated at ``/metrics``, along with the query time of each tile.
+"""
+
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import dataclasses
+import functools
+import hashlib
+import json
+import re
+import sys
+import time
+import typing
+
+import click
+import edgedb
+
+
+TILE_PATH = re.compile(
+    r'^/(?P<layer>[\w-]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$')
+MVT_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+# Web Mercator, which is what tileenvelope produces.
+TILE_SRID = 3857
+MAX_ZOOM = 30
+MAX_REQUEST_HEAD = 16 * 1024
+
+TILE_QUERY = '''
+    with
+        module ext::postgis,
+        bounds := tileenvelope(<int32>$z, <int32>$x, <int32>$y),
+        box := <box3d>bounds,
+        # Features within the clipping buffer are drawn as well, same as in
+        # build_tile.
+        envelope := expand(
+            bounds,
+            (xmax(box) - xmin(box)) * <int32>$buffer / <int32>$extent,
+        ),
+        area := transform(envelope, <int32>$srid),
+    select asmvt_agg(
+        (
+            for f in (select {type} filter op_overlaps(.{prop}, area))
+            union (
+                geom := asmvtgeom(
+                    transform(f.{prop}, <int32>{tile_srid}),
+                    <box2d>bounds,
+                    <int32>$extent,
+                    <int32>$buffer,
+                ),
+                properties := <json>(id := f.id),
+            )
+        ),
+        name := <str>$layer,
+        extent := <int32>$extent,
+    )
+'''
+
+
+@dataclasses.dataclass(frozen=True)
+class Layer:
+    name: str
+    query: str
+
+
+@dataclasses.dataclass(frozen=True)
+class Tile:
+    data: bytes
+    etag: str
+
+
+@dataclasses.dataclass
+class TileStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, elapsed: float) -> None:
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            'count': self.count,
+            'mean_ms': round(mean * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class LRUCache:
+    """Keep at most *size* entries, dropping the least recently used.
+
+    If *max_age* is set, entries older than that many seconds are dropped
+    as well.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        max_age: typing.Optional[float] = None,
+        *,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._size = size
+        self._max_age = max_age
+        self._clock = clock
+        self._data: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: typing.Hashable) -> typing.Any:
+        try:
+            stored, value = self._data[key]
+        except KeyError:
+            return None
+        if (
+            self._max_age is not None
+            and self._clock() - stored > self._max_age
+        ):
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: typing.Hashable, value: typing.Any) -> None:
+        if self._size <= 0:
+            return
+        self._data[key] = (self._clock(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._size:
+            self._data.popitem(last=False)
+
+    def items(self) -> typing.Iterator[tuple[typing.Any, typing.Any]]:
+        for key, (_, value) in self._data.items():
+            yield key, value
+
+
+class TileServer:
+
+    def __init__(
+        self,
+        client: edgedb.AsyncIOClient,
+        layers: dict[str, Layer],
+        *,
+        srid: int,
+        extent: int,
+        buffer: int,
+        cache_size: int,
+        max_age: int,
+    ) -> None:
+        self._client = client
+        self._layers = layers
+        self._srid = srid
+        self._extent = extent
+        self._buffer = buffer
+        self._max_age = max_age
+        # Nothing tells us when the features change, so cached tiles are
+        # only trusted for max_age seconds.
+        self._cache = LRUCache(cache_size, max_age)
+        self._pending: dict[tuple, asyncio.Task] = {}
+        # Query time is only tracked for as many tiles as are cached.
+        self._stats = LRUCache(cache_size)
+        self._requests = TileStats()
+        self._counters: collections.Counter = collections.Counter()
+
+    async def get_tile(self, key: tuple[str, int, int, int]) -> Tile:
+        tile = self._cache.get(key)
+        if tile is not None:
+            self._counters['hits'] += 1
+            return tile
+
+        task = self._pending.get(key)
+        if task is None:
+            self._counters['misses'] += 1
+            task = asyncio.ensure_future(self._fetch_tile(key))
+            task.add_done_callback(functools.partial(self._tile_done, key))
+            self._pending[key] = task
+        else:
+            # Someone is already fetching this tile, so wait for their
+            # result instead of running the same query again.
+            self._counters['coalesced'] += 1
+
+        # A client going away must not cancel the query for everyone else.
+        return await asyncio.shield(task)
+
+    def _tile_done(
+        self,
+        key: tuple[str, int, int, int],
+        task: asyncio.Task,
+    ) -> None:
+        del self._pending[key]
+        if not task.cancelled() and task.exception() is None:
+            self._cache.put(key, task.result())
+
+    async def _fetch_tile(self, key: tuple[str, int, int, int]) -> Tile:
+        name, z, x, y = key
+        start = time.perf_counter()
+        data = await self._client.query_single(
+            self._layers[name].query,
+            layer=name,
+            z=z,
+            x=x,
+            y=y,
+            srid=self._srid,
+            extent=self._extent,
+            buffer=self._buffer,
+        )
+        elapsed = time.perf_counter() - start
+
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = TileStats()
+            self._stats.put(key, stats)
+        stats.add(elapsed)
+
+        data = data or b''
+        etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return Tile(data=data, etag=f'"{etag}"')
+
+    def metrics(self) -> dict[str, typing.Any]:
+        return {
+            **self._counters,
+            'cached': len(self._cache),
+            'pending': len(self._pending),
+            'requests': self._requests.as_dict(),
+            'tiles': {
+                '/'.join(map(str, key)): stats.as_dict()
+                for key, stats in self._stats.items()
+            },
+        }
+
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.LimitOverrunError:
+            await self._respond(writer, 431, keep_alive=False)
+        finally:
+            writer.close()
+
+    async def _handle_request(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> bool:
+        head = await reader.readuntil(b'\r\n\r\n')
+        request, *lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = request.split(' ')
+        except ValueError:
+            await self._respond(writer, 400, keep_alive=False)
+            return False
+
+        headers = {}
+        for line in lines:
+            if line:
+                hname, _, value = line.partition(':')
+                headers[hname.strip().lower()] = value.strip()
+
+        keep_alive = (
+            headers.get('connection', '').lower() != 'close'
+            and version == 'HTTP/1.1'
+        )
+        if method not in {'GET', 'HEAD'}:
+            await self._respond(writer, 405, keep_alive=keep_alive)
+            return keep_alive
+        if 'content-length' in headers or 'transfer-encoding' in headers:
+            # We don't read request bodies, so we can't reuse the
+            # connection either.
+            keep_alive = False
+        head_only = method == 'HEAD'
+
+        path = target.partition('?')[0]
+        if path == '/metrics':
+            body = json.dumps(self.metrics()).encode()
+            await self._respond(
+                writer, 200, body,
+                content_type='application/json',
+                keep_alive=keep_alive,
+                head_only=head_only,
+            )
+            return keep_alive
+
+        key = self._parse_tile_path(path)
+        if key is None:
+            await self._respond(writer, 404, keep_alive=keep_alive)
+            return keep_alive
+
+        start = time.perf_counter()
+        try:
+            tile = await self.get_tile(key)
+        except edgedb.EdgeDBError as ex:
+            print(f'error: {"/".join(map(str, key))}: {ex}', file=sys.stderr)
+            await self._respond(writer, 502, keep_alive=keep_alive)
+            return keep_alive
+        elapsed = time.perf_counter() - start
+        self._requests.add(elapsed)
+
+        extra = {
+            'ETag': tile.etag,
+            'Cache-Control': f'max-age={self._max_age}',
+            'Server-Timing': f'tile;dur={elapsed * 1000:.3f}',
+        }
+        etags = _parse_etags(headers.get('if-none-match', ''))
+        if '*' in etags or tile.etag in etags:
+            await self._respond(
+                writer, 304, extra=extra, keep_alive=keep_alive)
+        else:
+            await self._respond(
+                writer, 200, tile.data,
+                content_type=MVT_CONTENT_TYPE,
+                extra=extra,
+                keep_alive=keep_alive,
+                head_only=head_only,
+            )
+        return keep_alive
+
+    def _parse_tile_path(
+        self,
+        path: str,
+    ) -> typing.Optional[tuple[str, int, int, int]]:
+        m = TILE_PATH.match(path)
+        if m is None or m['layer'] not in self._layers:
+            return None
+
+        z, x, y = int(m['z']), int(m['x']), int(m['y'])
+        if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            return None
+
+        return (m['layer'], z, x, y)
+
+    async def _respond(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: bytes = b'',
+        *,
+        content_type: str = 'text/plain',
+        extra: typing.Optional[dict[str, str]] = None,
+        keep_alive: bool = True,
+        head_only: bool = False,
+    ) -> None:
+        if status >= 400 and not body:
+            body = HTTP_REASONS[status].encode()
+
+        headers = {
+            'Content-Length': str(len(body)) if status != 304 else None,
+            'Content-Type': content_type if status != 304 else None,
+            'Access-Control-Allow-Origin': '*',
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            **(extra or {}),
+        }
+        head = f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n' + ''.join(
+            f'{hname}: {value}\r\n'
+            for hname, value in headers.items()
+            if value is not None
+        )
+        writer.write(head.encode('latin-1') + b'\r\n')
+        if status != 304 and not head_only:
+            writer.write(body)
+        await writer.drain()
+
+
+HTTP_REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+    502: 'Bad Gateway',
+}
+
+
+def _parse_etags(value: str) -> set[str]:
+    if value.strip() == '*':
+        return {'*'}
+    # Weak validators are fine for a GET, so compare them as strong ones.
+    return {
+        tag.strip().removeprefix('W/')
+        for tag in value.split(',')
+        if tag.strip()
+    }
+
+
+def _parse_layer(spec: str) -> Layer:
+    name, sep, source = spec.partition('=')
+    typename, _, prop = source.rpartition('.')
+    if not sep or not name or not typename or not prop:
+        raise click.BadParameter(
+            f'expected NAME=TYPE.PROPERTY, got {spec!r}')
+    if not re.fullmatch(r'[\w-]+', name):
+        raise click.BadParameter(f'invalid layer name {name!r}')
+    if '::' not in typename:
+        # The query runs in the ext::postgis module.
+        typename = f'default::{typename}'
+
+    query = TILE_QUERY.replace(
+        '{type}', typename
+    ).replace(
+        '{prop}', prop
+    ).replace(
+        '{tile_srid}', str(TILE_SRID)
+    )
+    return Layer(name=name, query=query)
+
+
+async def serve(
+    layers: dict[str, Layer],
+    *,
+    host: str,
+    port: int,
+    dsn: typing.Optional[str],
+    instance: typing.Optional[str],
+    concurrency: typing.Optional[int],
+    **kwargs: typing.Any,
+) -> None:
+    client = edgedb.create_async_client(
+        dsn or instance,
+        max_concurrency=concurrency,
+    )
+    await client.ensure_connected()
+    try:
+        app = TileServer(client, layers, **kwargs)
+        server = await asyncio.start_server(
+            app.handle, host, port, limit=MAX_REQUEST_HEAD)
+        for sock in server.sockets:
+            name = sock.getsockname()
+            print(f'serving tiles on http://{name[0]}:{name[1]}/')
+        async with server:
+            await server.serve_forever()
+    finally:
+        await client.aclose()
+
+
+@click.command('tile-server')
+@click.option('--layer', 'layer_specs', multiple=True, required=True,
+              metavar='NAME=TYPE.PROPERTY',
+              help='Serve the geometry PROPERTY of TYPE as layer NAME.')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=8080, show_default=True)
+@click.option('--dsn', help='DSN of the database to query.')
+@click.option('-I', '--instance', help='Name of the instance to query.')
+@click.option('--concurrency', type=int,
+              help='Maximum number of pooled database connections.')
+@click.option('--srid', type=int, default=4326, show_default=True,
+              help='SRID of the stored geometries.')
+@click.option('--extent', type=int, default=4096, show_default=True,
+              help='Tile extent in tile coordinate space.')
+@click.option('--buffer', type=int, default=256, show_default=True,
+              help='Clipping buffer in tile coordinate space.')
+@click.option('--cache-size', type=int, default=10000, show_default=True,
+              help='Number of tiles kept in memory.')
+@click.option('--max-age', type=int, default=60, show_default=True,
+              help='Seconds a tile is served without querying it again.')
+def tile_server(*, layer_specs, **kwargs):
+    """Serve vector tiles of ext::postgis geometries over HTTP.
+    """
+    layers = {}
+    for spec in layer_specs:
+        layer = _parse_layer(spec)
+        layers[layer.name] = layer
+
+    try:
+        asyncio.run(serve(layers, **kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    tile_server()
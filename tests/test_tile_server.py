@@ -0,0 +1,310 @@
+#
+# This source file is part of the EdgeDB open source project.
+#
+# Copyright 2024-present MagicStack Inc. and the EdgeDB authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+
+import click
+import edgedb
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+import tile_server  # NoQA
+
+
+class FakeClient:
+    # Stands in for the database, returning a tile per query.
+
+    def __init__(self):
+        self.calls = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.error = None
+
+    async def query_single(self, query, **kwargs):
+        self.calls.append(kwargs)
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return f'{kwargs["z"]}/{kwargs["x"]}/{kwargs["y"]}'.encode()
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTileServerParsing(unittest.TestCase):
+
+    def test_tile_server_parse_layer_01(self):
+        layer = tile_server._parse_layer('roads=default::Road.geometry')
+        self.assertEqual(layer.name, 'roads')
+        self.assertIn('select default::Road filter', layer.query)
+        self.assertIn('op_overlaps(.geometry, area)', layer.query)
+        self.assertIn(
+            f'transform(f.geometry, <int32>{tile_server.TILE_SRID})',
+            layer.query,
+        )
+        self.assertNotIn('{', layer.query)
+
+    def test_tile_server_parse_layer_02(self):
+        # Types without a module are looked up in the default module.
+        layer = tile_server._parse_layer('roads=Road.geometry')
+        self.assertIn('select default::Road filter', layer.query)
+
+        layer = tile_server._parse_layer('roads=geo::Road.geometry')
+        self.assertIn('select geo::Road filter', layer.query)
+
+    def test_tile_server_parse_layer_03(self):
+        for spec in [
+            'roads',
+            'roads=',
+            '=Road.geometry',
+            'roads=Road',
+            'roads=Road.',
+            'roads/1=Road.geometry',
+        ]:
+            with self.assertRaises(click.BadParameter, msg=spec):
+                tile_server._parse_layer(spec)
+
+    def test_tile_server_parse_etags_01(self):
+        self.assertEqual(tile_server._parse_etags(''), set())
+        self.assertEqual(tile_server._parse_etags('*'), {'*'})
+        self.assertEqual(tile_server._parse_etags(' * '), {'*'})
+        self.assertEqual(tile_server._parse_etags('"a"'), {'"a"'})
+        self.assertEqual(
+            tile_server._parse_etags('"a", W/"b",, "c"'),
+            {'"a"', '"b"', '"c"'},
+        )
+
+    def test_tile_server_lru_01(self):
+        cache = tile_server.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # Reading 'a' makes 'b' the least recently used entry.
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(list(cache.items()), [('a', 1), ('c', 3)])
+
+    def test_tile_server_lru_02(self):
+        # Replacing an entry doesn't evict anything.
+        cache = tile_server.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('a', 3)
+        self.assertEqual(list(cache.items()), [('b', 2), ('a', 3)])
+
+        # A cache without room doesn't keep anything.
+        cache = tile_server.LRUCache(0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+
+    def test_tile_server_lru_03(self):
+        clock = FakeClock()
+        cache = tile_server.LRUCache(2, 10, clock=clock)
+        cache.put('a', 1)
+        clock.now = 5
+        cache.put('b', 2)
+
+        clock.now = 10
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+
+class TestTileServer(unittest.IsolatedAsyncioTestCase):
+
+    def make_server(self, **kwargs):
+        self.client = FakeClient()
+        layers = {
+            'roads': tile_server._parse_layer('roads=Road.geometry'),
+        }
+        return tile_server.TileServer(
+            self.client,
+            layers,
+            **{
+                'srid': 4326,
+                'extent': 4096,
+                'buffer': 256,
+                'cache_size': 10,
+                'max_age': 60,
+                **kwargs,
+            },
+        )
+
+    async def request(self, server, target, *headers):
+        reader = asyncio.StreamReader()
+        reader.feed_data(
+            f'GET {target} HTTP/1.1\r\n'.encode()
+            + b''.join(f'{h}\r\n'.encode() for h in headers)
+            + b'\r\n'
+        )
+        reader.feed_eof()
+        writer = FakeWriter()
+        await server._handle_request(reader, writer)
+
+        head, _, body = writer.data.partition(b'\r\n\r\n')
+        status, *lines = head.decode('latin-1').split('\r\n')
+        return (
+            int(status.split(' ')[1]),
+            dict(line.split(': ', 1) for line in lines),
+            body,
+        )
+
+    async def test_tile_server_coalesce_01(self):
+        # Concurrent requests for a tile share a single query.
+        server = self.make_server()
+        self.client.release.clear()
+        key = ('roads', 1, 0, 1)
+        tasks = [
+            asyncio.ensure_future(server.get_tile(key))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        self.client.release.set()
+        tiles = await asyncio.gather(*tasks)
+
+        self.assertEqual(len(self.client.calls), 1)
+        self.assertEqual({tile.data for tile in tiles}, {b'1/0/1'})
+        self.assertEqual(len({tile.etag for tile in tiles}), 1)
+
+        metrics = server.metrics()
+        self.assertEqual(metrics['misses'], 1)
+        self.assertEqual(metrics['coalesced'], 2)
+        self.assertEqual(metrics['pending'], 0)
+        self.assertEqual(metrics['cached'], 1)
+
+        # Afterwards the tile is served from the cache.
+        await server.get_tile(key)
+        self.assertEqual(len(self.client.calls), 1)
+        self.assertEqual(server.metrics()['hits'], 1)
+
+    async def test_tile_server_coalesce_02(self):
+        # A failed query is reported to everyone waiting for it, but it is
+        # not cached.
+        server = self.make_server()
+        self.client.release.clear()
+        self.client.error = edgedb.EdgeDBError('boom')
+        key = ('roads', 0, 0, 0)
+        tasks = [
+            asyncio.ensure_future(server.get_tile(key))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        self.client.release.set()
+        res = await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.assertEqual(len(self.client.calls), 1)
+        for ex in res:
+            self.assertIsInstance(ex, edgedb.EdgeDBError)
+
+        self.client.error = None
+        tile = await server.get_tile(key)
+        self.assertEqual(tile.data, b'0/0/0')
+        self.assertEqual(len(self.client.calls), 2)
+
+    async def test_tile_server_max_age_01(self):
+        server = self.make_server(max_age=0)
+        key = ('roads', 0, 0, 0)
+        await server.get_tile(key)
+        await asyncio.sleep(0.01)
+        await server.get_tile(key)
+        self.assertEqual(len(self.client.calls), 2)
+
+        status, headers, _ = await self.request(server, '/roads/0/0/0.mvt')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Cache-Control'], 'max-age=0')
+
+    async def test_tile_server_request_01(self):
+        server = self.make_server()
+        status, headers, body = await self.request(server, '/roads/1/1/0.mvt')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'1/1/0')
+        self.assertEqual(
+            headers['Content-Type'], tile_server.MVT_CONTENT_TYPE)
+        self.assertTrue(headers['Server-Timing'].startswith('tile;dur='))
+        etag = headers['ETag']
+
+        for match in [etag, f'W/{etag}', f'"other", {etag}', '*']:
+            status, headers, body = await self.request(
+                server, '/roads/1/1/0.mvt', f'If-None-Match: {match}')
+            self.assertEqual(status, 304, match)
+            self.assertEqual(body, b'')
+
+        status, _, body = await self.request(
+            server, '/roads/1/1/0.mvt', 'If-None-Match: "other"')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'1/1/0')
+
+    async def test_tile_server_request_02(self):
+        server = self.make_server()
+        for target in [
+            '/rivers/0/0/0.mvt',
+            '/roads/1/2/0.mvt',
+            '/roads/0/0/0.png',
+            f'/roads/{tile_server.MAX_ZOOM + 1}/0/0.mvt',
+        ]:
+            status, _, _ = await self.request(server, target)
+            self.assertEqual(status, 404, target)
+
+        self.assertEqual(self.client.calls, [])
+
+    async def test_tile_server_metrics_01(self):
+        # Every tile request is counted in the request latency, whether or
+        # not the tile was cached.
+        server = self.make_server()
+        for _ in range(3):
+            await self.request(server, '/roads/0/0/0.mvt')
+
+        status, _, body = await self.request(server, '/metrics')
+        self.assertEqual(status, 200)
+        metrics = json.loads(body)
+        self.assertEqual(metrics['requests']['count'], 3)
+        self.assertEqual(metrics['hits'], 2)
+        self.assertEqual(metrics['misses'], 1)
+        self.assertEqual(metrics['tiles']['roads/0/0/0']['count'], 1)